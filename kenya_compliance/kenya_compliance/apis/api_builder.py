@@ -211,6 +211,9 @@ class EndpointsBuilder(BaseEndpointsBuilder):
             if response["resultCd"] == "000":
                 # Success callback handler here
                 self._success_callback_handler(response)
+                # KRA has accepted the request, so persist the callback's writes
+                # before any later bookkeeping can fail and roll them back
+                frappe.db.commit()
 
                 update_last_request_date(response["resultDt"], route_path)
                 update_integration_request(
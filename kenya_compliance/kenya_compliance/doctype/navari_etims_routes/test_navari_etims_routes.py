@@ -27,14 +27,8 @@ class TestNavarieTimsRoutes(FrappeTestCase):
         child.parent_field = "routes_table"
         child.last_request_date = test_time
         child.save()
+        child.reload()
 
-        added_child = frappe.db.get_value(
-            ROUTES_TABLE_CHILD_DOCTYPE_NAME,
-            {"url_path_function": "testing"},
-            ["*"],
-            as_dict=True,
-        )
-
-        self.assertTrue(added_child.url_path.startswith("/"))
-        self.assertEqual(added_child.url_path, "/test_url_path")
-        self.assertEqual(added_child.last_request_date, test_time)
+        self.assertTrue(child.url_path.startswith("/"))
+        self.assertEqual(child.url_path, "/test_url_path")
+        self.assertEqual(child.last_request_date, test_time)
@@ -4,6 +4,11 @@
 # import frappe
 from frappe.model.document import Document
 
+from ...utils import clear_etims_settings_cache, invalidate_etims_headers_cache
+
 
 class NavariKRAeTimsEnvironmentIdentifier(Document):
-	pass
+	def on_update(self) -> None:
+		"""On Change Hook"""
+		clear_etims_settings_cache()
+		invalidate_etims_headers_cache()
@@ -20,7 +20,9 @@ from ...background_tasks.tasks import (
 from ...handlers import handle_errors
 from ...logger import etims_logger
 from ...utils import (
+    clear_etims_settings_cache,
     get_route_path,
+    invalidate_etims_headers_cache,
     is_valid_kra_pin,
     is_valid_url,
     make_post_request,
@@ -126,6 +128,9 @@ class NavariKRAeTimsSettings(Document):
 
     def on_update(self) -> None:
         """On Change Hook"""
+        clear_etims_settings_cache()
+        invalidate_etims_headers_cache()
+
         if not self.is_active:
             active_envs = frappe.get_all(
                 SETTINGS_DOCTYPE_NAME,
@@ -224,6 +229,11 @@ class NavariKRAeTimsSettings(Document):
 
             purchase_information_task.save()
 
+    def on_trash(self) -> None:
+        """On Delete Hook"""
+        clear_etims_settings_cache()
+        invalidate_etims_headers_cache()
+
     def before_insert(self) -> None:
         """Before Insertion Hook"""
         route_path, last_request_date = get_route_path("DeviceVerificationReq")
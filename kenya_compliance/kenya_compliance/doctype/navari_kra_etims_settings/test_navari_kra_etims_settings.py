@@ -2,18 +2,20 @@
 # See license.txt
 
 from unittest.mock import patch
+
 import frappe
 from frappe.model.delete_doc import delete_doc
 from frappe.model.document import Document
 from frappe.tests.utils import FrappeTestCase
 
+from ...background_tasks.tasks import send_sales_invoices_information
+from ...utils import HEADERS_CACHE_KEY
 from ..doctype_names_mapping import (
     PRODUCTION_SERVER_URL,
     SANDBOX_SERVER_URL,
     SETTINGS_DOCTYPE_NAME,
 )
 from .navari_kra_etims_settings import NavariKRAeTimsSettings
-from ...background_tasks.tasks import send_sales_invoices_information
 
 
 def mock_before_insert(*args) -> None:
@@ -283,3 +285,34 @@ class TestNavariKRAeTimsSettings(FrappeTestCase):
         new_setting.save()
 
         self.assertTrue(frappe.db.exists("Accounting Dimension", "Branch", cache=False))
+
+    def test_saving_settings_invalidates_caches(self) -> None:
+        new_setting = frappe.new_doc(SETTINGS_DOCTYPE_NAME)
+
+        new_setting.bhfid = "00"
+        new_setting.is_active = 1
+        new_setting.company = "Compliance Test Company"
+        new_setting.tin = "A123456789Z"
+        new_setting.dvcsrlno = "123456"
+
+        new_setting.save()
+
+        headers_key = f"{HEADERS_CACHE_KEY}:Compliance Test Company:00"
+        stale_headers = {"cmcKey": "stale communication key"}
+
+        frappe.local.etims_settings_cache = {
+            ("Compliance Test Company", "00"): frappe._dict(name=new_setting.name)
+        }
+        frappe.cache().set_value(headers_key, stale_headers, expires_in_sec=60)
+
+        new_setting.communication_key = "new communication key"
+        new_setting.save()
+
+        self.assertEqual(frappe.local.etims_settings_cache, {})
+        self.assertIsNone(frappe.cache().get_value(headers_key, expires=True))
+
+        # Simulate a concurrent request re-caching the headers before the commit
+        frappe.cache().set_value(headers_key, stale_headers, expires_in_sec=60)
+        frappe.db.commit()
+
+        self.assertIsNone(frappe.cache().get_value(headers_key, expires=True))
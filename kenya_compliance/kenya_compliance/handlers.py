@@ -34,3 +34,5 @@ def handle_errors(
 
     finally:
         update_last_request_date(response["resultDt"], route)
+        # Persist the request bookkeeping before the error rolls back the transaction
+        frappe.db.commit()
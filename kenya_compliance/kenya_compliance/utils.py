@@ -1,12 +1,18 @@
 """Utility functions"""
 
+import asyncio
+import atexit
+import os
 import re
+import threading
 from base64 import b64encode
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
 from io import BytesIO
-from typing import Literal
+from typing import Any, Coroutine, Literal, TypeVar
 
 import aiohttp
+import orjson
 import qrcode
 
 import frappe
@@ -21,6 +27,40 @@ from .doctype.doctype_names_mapping import (
 )
 from .logger import etims_logger
 
+T = TypeVar("T")
+
+_session: aiohttp.ClientSession | None = None
+_session_loop: asyncio.AbstractEventLoop | None = None
+_session_loop_lock = threading.Lock()
+
+HEADERS_CACHE_KEY = "etims_headers"
+HEADERS_CACHE_EXPIRY_SECONDS = 60 * 60
+
+# Sales payload fields that do not vary between invoices
+INVOICE_PAYLOAD_CONSTANTS = {
+    "custNm": None,
+    "cnclReqDt": None,
+    "cnclDt": None,
+    "rfdDt": None,
+    "rfdRsnCd": None,
+    "taxRtA": 0,
+    "taxRtC": 0,
+    "taxRtD": 0,
+    "prchrAcptcYn": "N",
+    "remark": None,
+}
+INVOICE_RECEIPT_CONSTANTS = {
+    "custMblNo": None,
+    "rptNo": 1,
+    "trdeNm": "",
+    "adrs": "",
+    "topMsg": "ERPNext",
+    "btmMsg": "Welcome",
+    "prchrAcptcYn": "N",
+}
+
+_URL_PATTERN = re.compile(r"^(https?|ftp)://[^\s/$.?#].[^\s]*")
+
 
 def is_valid_kra_pin(pin: str) -> bool:
     """Checks if the string provided conforms to the pattern of a KRA PIN.
@@ -33,8 +73,106 @@ def is_valid_kra_pin(pin: str) -> bool:
     Returns:
         bool: True if input is a valid KRA PIN, False otherwise
     """
-    pattern = r"^[a-zA-Z]{1}[0-9]{9}[a-zA-Z]{1}$"
-    return bool(re.match(pattern, pin))
+    return (
+        len(pin) == 11
+        and pin.isascii()
+        and pin[0].isalpha()
+        and pin[1:10].isdigit()
+        and pin[10].isalpha()
+    )
+
+
+def _get_session_loop() -> asyncio.AbstractEventLoop:
+    """Returns the long-lived event loop that owns the shared HTTP session.
+
+    Callers drive requests through asyncio.run(), which creates and closes a new
+    event loop on every call. Since a ClientSession is bound to the loop it was
+    created on, the shared session lives on a dedicated background loop instead.
+
+    Returns:
+        asyncio.AbstractEventLoop: The session's event loop
+    """
+    global _session_loop
+
+    with _session_loop_lock:
+        if _session_loop is None:
+            _session_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_session_loop.run_forever, name="etims-http", daemon=True
+            ).start()
+
+    return _session_loop
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """Lazily creates the HTTP session shared by all outbound requests.
+    Must only be called from coroutines running on the session's event loop.
+
+    Returns:
+        aiohttp.ClientSession: The shared session
+    """
+    global _session
+
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100, limit_per_host=20, ttl_dns_cache=600, keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=60),
+        )
+
+    return _session
+
+
+async def _run_on_session_loop(coroutine: Coroutine[Any, Any, T]) -> T:
+    """Runs the coroutine on the session's event loop and awaits its result"""
+    future = asyncio.run_coroutine_threadsafe(coroutine, _get_session_loop())
+
+    return await asyncio.wrap_future(future)
+
+
+def _close_session() -> None:
+    """Closes the shared HTTP session and stops its event loop on shutdown"""
+    if _session_loop is None:
+        return
+
+    if _session is not None and not _session.closed:
+        try:
+            asyncio.run_coroutine_threadsafe(_session.close(), _session_loop).result(
+                timeout=5
+            )
+        except FutureTimeoutError:
+            pass
+
+    _session_loop.call_soon_threadsafe(_session_loop.stop)
+
+
+def _reset_session_state() -> None:
+    """Discards the parent's session in forked workers, whose loop thread is gone"""
+    global _session, _session_loop
+
+    _session, _session_loop = None, None
+
+
+atexit.register(_close_session)
+os.register_at_fork(after_in_child=_reset_session_state)
+
+
+async def _post(
+    url: str,
+    data: dict[str, str] | None = None,
+    headers: dict[str, str | int] | None = None,
+) -> dict[str, str | dict]:
+    """Posts data over the shared session. Must run on the session's event loop.
+    Payloads are serialised with orjson, which emits bytes directly."""
+    body = None
+
+    if data is not None:
+        body = orjson.dumps(data)
+        headers = {**(headers or {}), "Content-Type": "application/json"}
+
+    async with _get_session().post(url, data=body, headers=headers) as response:
+        return orjson.loads(await response.read())
 
 
 async def make_get_request(url: str) -> dict[str, str] | str:
@@ -46,13 +184,16 @@ async def make_get_request(url: str) -> dict[str, str] | str:
     Returns:
         dict: The Response
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
+
+    async def _get() -> dict[str, str] | str:
+        async with _get_session().get(url) as response:
             if response.content_type.startswith("text"):
                 return await response.text()
 
             return await response.json()
 
+    return await _run_on_session_loop(_get())
+
 
 async def make_post_request(
     url: str,
@@ -69,11 +210,7 @@ async def make_post_request(
     Returns:
         dict: The Server Response
     """
-    # TODO: Refactor to a more efficient handling of creation of the session object
-    # as described in documentation
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=data, headers=headers) as response:
-            return await response.json()
+    return await _run_on_session_loop(_post(url, data, headers))
 
 
 def build_datetime_from_string(
@@ -88,11 +225,58 @@ def build_datetime_from_string(
     Returns:
         datetime: The datetime object
     """
+    try:
+        # Fast paths for the fixed-width formats used on every submission
+        if format == "%Y%m%d%H%M%S" and len(date_string) == 14:
+            return _parse_compact_datetime(date_string)
+
+        if format == "%Y-%m-%d %H:%M:%S" and len(date_string) == 19:
+            return _parse_separated_datetime(date_string)
+
+    except ValueError:
+        pass
+
     date_object = datetime.strptime(date_string, format)
 
     return date_object
 
 
+def _parse_compact_datetime(date_string: str) -> datetime:
+    """Parses a datetime string in the fixed-width %Y%m%d%H%M%S format"""
+    if not (date_string.isascii() and date_string.isdigit()):
+        raise ValueError(f"Invalid datetime string: {date_string}")
+
+    return datetime(
+        int(date_string[0:4]),
+        int(date_string[4:6]),
+        int(date_string[6:8]),
+        int(date_string[8:10]),
+        int(date_string[10:12]),
+        int(date_string[12:14]),
+    )
+
+
+def _parse_separated_datetime(date_string: str) -> datetime:
+    """Parses a datetime string in the fixed-width %Y-%m-%d %H:%M:%S format"""
+    if (
+        date_string[4] != "-"
+        or date_string[7] != "-"
+        or date_string[10] != " "
+        or date_string[13] != ":"
+        or date_string[16] != ":"
+    ):
+        raise ValueError(f"Invalid datetime string: {date_string}")
+
+    return _parse_compact_datetime(
+        date_string[0:4]
+        + date_string[5:7]
+        + date_string[8:10]
+        + date_string[11:13]
+        + date_string[14:16]
+        + date_string[17:19]
+    )
+
+
 def is_valid_url(url: str) -> bool:
     """Validates input is a valid URL
 
@@ -102,8 +286,7 @@ def is_valid_url(url: str) -> bool:
     Returns:
         bool: Validation result
     """
-    pattern = r"^(https?|ftp):\/\/[^\s/$.?#].[^\s]*"
-    return bool(re.match(pattern, url))
+    return _URL_PATTERN.match(url) is not None
 
 
 def get_route_path(
@@ -116,12 +299,14 @@ def get_route_path(
         url_path,
         last_request_date
     FROM `tab{routes_table_doctype}`
-    WHERE url_path_function LIKE '{search_field}'
-    AND parent LIKE '{ROUTES_TABLE_DOCTYPE_NAME}'
+    WHERE url_path_function = %s
+    AND parent = %s
     LIMIT 1
     """
 
-    results = frappe.db.sql(query, as_dict=True)
+    results = frappe.db.sql(
+        query, (search_field, ROUTES_TABLE_DOCTYPE_NAME), as_dict=True
+    )
 
     if results:
         return (results[0].url_path, results[0].last_request_date)
@@ -130,10 +315,26 @@ def get_route_path(
 def get_environment_settings(
     company_name: str,
     doctype: str = SETTINGS_DOCTYPE_NAME,
-    environment: str = "Sandbox",
+    environment: str | None = "Sandbox",
     branch_id: str = "00",
 ) -> Document | None:
+    """Fetches the active settings record for the company, environment, and branch.
+    When environment is None, the currently configured environment is resolved
+    within the same query.
+    """
     error_message = None
+    environment_condition = "%s"
+    values = [company_name, environment]
+
+    if environment is None:
+        environment_condition = """(
+            SELECT value
+            FROM `tabSingles`
+            WHERE doctype = %s
+                AND field = 'environment'
+        )"""
+        values = [company_name, ENVIRONMENT_SPECIFICATION_DOCTYPE_NAME]
+
     query = f"""
     SELECT server_url,
         name,
@@ -144,8 +345,8 @@ def get_environment_settings(
         communication_key,
         most_recent_sales_number
     FROM `tab{doctype}`
-    WHERE company = '{company_name}'
-        AND env = '{environment}'
+    WHERE company = %s
+        AND env = {environment_condition}
         AND name IN (
             SELECT name
             FROM `tab{doctype}`
@@ -154,13 +355,17 @@ def get_environment_settings(
     """
 
     if branch_id:
-        query += f"AND bhfid = '{branch_id}';"
+        query += "AND bhfid = %s"
+        values.append(branch_id)
 
-    setting_doctype = frappe.db.sql(query, as_dict=True)
+    setting_doctype = frappe.db.sql(query, values, as_dict=True)
 
     if setting_doctype:
         return setting_doctype[0]
 
+    if environment is None:
+        environment = get_current_environment_state()
+
     error_message = f"""
         There is no valid environment setting for these credentials:
             <ul>
@@ -208,6 +413,12 @@ def get_server_url(company_name: str, branch_id: str = "00") -> str | None:
 
 
 def build_headers(company_name: str, branch_id: str = "00") -> dict[str, str] | None:
+    key = f"{HEADERS_CACHE_KEY}:{company_name}:{branch_id}"
+    cached_headers = frappe.cache().get_value(key, expires=True)
+
+    if cached_headers:
+        return dict(cached_headers)
+
     settings = get_curr_env_etims_settings(company_name, branch_id=branch_id)
 
     if settings:
@@ -217,18 +428,35 @@ def build_headers(company_name: str, branch_id: str = "00") -> dict[str, str] |
             "cmcKey": settings.get("communication_key"),
             "Content-Type": "application/json",
         }
+        frappe.cache().set_value(
+            key, headers, expires_in_sec=HEADERS_CACHE_EXPIRY_SECONDS
+        )
+
+        return dict(headers)
+
+
+def clear_etims_headers_cache() -> None:
+    """Clears the request headers cached for all companies and branches"""
+    frappe.cache().delete_keys(HEADERS_CACHE_KEY)
+
 
-        return headers
+def invalidate_etims_headers_cache() -> None:
+    """Clears the cached request headers now, and again once the current
+    transaction commits so that concurrent requests cannot re-cache stale values
+    in between."""
+    clear_etims_headers_cache()
+    frappe.db.after_commit.add(clear_etims_headers_cache)
 
 
 def extract_document_series_number(document: Document) -> int | None:
-    split_invoice_name = document.name.split("-")
+    name = document.name
+    separators = name.count("-")
 
-    if len(split_invoice_name) == 4:
-        return int(split_invoice_name[-1])
+    if separators == 3:
+        return int(name.rsplit("-", 1)[-1])
 
-    if len(split_invoice_name) == 5:
-        return int(split_invoice_name[-2])
+    if separators == 4:
+        return int(name.rsplit("-", 2)[-2])
 
 
 def build_invoice_payload(
@@ -271,63 +499,53 @@ def build_invoice_payload(
     if most_recent_sales_number >= 0:
         invoice_number = most_recent_sales_number + 1
 
+    customer_tin = invoice.tax_id if invoice.tax_id else None
+    net_total = abs(invoice.base_net_total)
+
     payload = {
+        **INVOICE_PAYLOAD_CONSTANTS,
         "invcNo": invoice_number,
         "orgInvcNo": (
             0
             if invoice_type_identifier == "S"
-            else frappe.get_doc(
-                "Sales Invoice", invoice.return_against
-            ).custom_submission_sequence_number
+            else frappe.db.get_value(
+                invoice.doctype,
+                invoice.return_against,
+                "custom_submission_sequence_number",
+            )
         ),
         "trdInvcNo": invoice.name,
-        "custTin": invoice.tax_id if invoice.tax_id else None,
-        "custNm": None,
+        "custTin": customer_tin,
         "rcptTyCd": invoice_type_identifier if invoice_type_identifier == "S" else "R",
         "pmtTyCd": invoice.custom_payment_type_code,
         "salesSttsCd": invoice.custom_transaction_progress_code,
         "cfmDt": validated_date,
         "salesDt": sales_date,
         "stockRlsDt": validated_date,
-        "cnclReqDt": None,
-        "cnclDt": None,
-        "rfdDt": None,
-        "rfdRsnCd": None,
         "totItemCnt": len(items_list),
         "taxblAmtA": invoice.custom_taxbl_amount_a,
         "taxblAmtB": invoice.custom_taxbl_amount_b,
         "taxblAmtC": invoice.custom_taxbl_amount_c,
         "taxblAmtD": invoice.custom_taxbl_amount_d,
         "taxblAmtE": invoice.custom_taxbl_amount_e,
-        "taxRtA": 0,
         "taxRtB": 16 if invoice.custom_tax_b else 0,
-        "taxRtC": 0,
-        "taxRtD": 0,
         "taxRtE": 8 if invoice.custom_tax_e else 0,
         "taxAmtA": invoice.custom_tax_a,
         "taxAmtB": invoice.custom_tax_b,
         "taxAmtC": invoice.custom_tax_c,
         "taxAmtD": invoice.custom_tax_d,
         "taxAmtE": invoice.custom_tax_e,
-        "totTaxblAmt": abs(invoice.base_net_total),
+        "totTaxblAmt": net_total,
         "totTaxAmt": abs(invoice.total_taxes_and_charges),
-        "totAmt": abs(invoice.base_net_total),
-        "prchrAcptcYn": "N",
-        "remark": None,
+        "totAmt": net_total,
         "regrId": invoice.owner,
         "regrNm": invoice.owner,
         "modrId": invoice.modified_by,
         "modrNm": invoice.modified_by,
         "receipt": {
-            "custTin": invoice.tax_id if invoice.tax_id else None,
-            "custMblNo": None,
-            "rptNo": 1,
+            **INVOICE_RECEIPT_CONSTANTS,
+            "custTin": customer_tin,
             "rcptPbctDt": validated_date,
-            "trdeNm": "",
-            "adrs": "",
-            "topMsg": "ERPNext",
-            "btmMsg": "Welcome",
-            "prchrAcptcYn": "N",
         },
         "itemList": items_list,
     }
@@ -347,19 +565,18 @@ def get_invoice_items_list(invoice: Document) -> list[dict[str, str | int | None
     item_taxes = get_itemised_tax_breakup_data(invoice)
     items_list = []
 
-    for index, item in enumerate(invoice.items):
-        taxable_amount = round(int(item_taxes[index]["taxable_amount"]) / item.qty, 2)
-        actual_tax_amount = 0
+    # The tax head's description is the same for every item, so resolve it once
+    tax_key = "VAT" if item_taxes and "VAT" in item_taxes[0] else "VAT @ 16.0"
 
-        try:
-            actual_tax_amount = item_taxes[index]["VAT"]["tax_amount"]
-        except KeyError:
-            actual_tax_amount = item_taxes[index]["VAT @ 16.0"]["tax_amount"]
+    for item, item_tax in zip(invoice.items, item_taxes, strict=True):
+        taxable_amount = round(int(item_tax["taxable_amount"]) / item.qty, 2)
+        actual_tax_amount = item_tax[tax_key]["tax_amount"]
 
         tax_amount = round(
             (actual_tax_amount) / item.qty,
             2,
         )
+        rate = round(item.base_rate, 2)
 
         items_list.append(
             {
@@ -372,8 +589,8 @@ def get_invoice_items_list(invoice: Document) -> list[dict[str, str | int | None
                 "pkg": 1,
                 "qtyUnitCd": item.custom_unit_of_quantity_code,
                 "qty": abs(item.qty),
-                "prc": round(item.base_rate, 2),
-                "splyAmt": round(item.base_rate, 2),
+                "prc": rate,
+                "splyAmt": rate,
                 "dcRt": round(item.discount_percentage, 2) or 0,
                 "dcAmt": round(item.discount_amount, 2) or 0,
                 "isrccCd": None,
@@ -395,39 +612,51 @@ def update_last_request_date(
     route: str,
     routes_table: str = ROUTES_TABLE_CHILD_DOCTYPE_NAME,
 ) -> None:
-    doc = frappe.get_doc(
+    frappe.db.set_value(
         routes_table,
         {"url_path": route},
-        ["*"],
+        "last_request_date",
+        build_datetime_from_string(response_datetime, "%Y%m%d%H%M%S"),
+        update_modified=False,
     )
 
-    doc.last_request_date = build_datetime_from_string(
-        response_datetime, "%Y%m%d%H%M%S"
-    )
-
-    doc.save()
-    frappe.db.commit()
-
 
 def get_curr_env_etims_settings(
     company_name: str, branch_id: str = "00"
 ) -> Document | None:
-    current_environment = get_current_environment_state(
-        ENVIRONMENT_SPECIFICATION_DOCTYPE_NAME
-    )
+    key = (company_name, branch_id)
+    cache = getattr(frappe.local, "etims_settings_cache", None)
+
+    if cache is None:
+        cache = frappe.local.etims_settings_cache = {}
+
+    if key in cache:
+        return cache[key]
+
     settings = get_environment_settings(
-        company_name, environment=current_environment, branch_id=branch_id
+        company_name, environment=None, branch_id=branch_id
     )
 
     if settings:
+        cache[key] = settings
+
         return settings
 
 
+def clear_etims_settings_cache() -> None:
+    """Clears the settings records cached for the current request"""
+    frappe.local.etims_settings_cache = {}
+
+
 def get_most_recent_sales_number(company_name: str) -> int | None:
     settings = get_curr_env_etims_settings(company_name)
 
     if settings:
-        return settings.most_recent_sales_number
+        # The counter advances with every accepted submission, possibly in other
+        # jobs, so it is always read fresh rather than from the cached settings row
+        return frappe.db.get_value(
+            SETTINGS_DOCTYPE_NAME, settings.name, "most_recent_sales_number"
+        )
 
     return
 
@@ -441,8 +670,11 @@ def get_qr_code(data: str) -> str:
     Returns:
         str: The QR Code.
     """
-    qr_code_bytes = get_qr_code_bytes(data, format="PNG")
-    base_64_string = bytes_to_base64_string(qr_code_bytes)
+    buffered = BytesIO()
+    write_qr_code(data, buffered, format="PNG")
+
+    # Encode straight from the buffer's memory instead of copying it out first
+    base_64_string = b64encode(buffered.getbuffer()).decode("ascii")
 
     return add_file_info(base_64_string)
 
@@ -454,16 +686,7 @@ def add_file_info(data: str) -> str:
     return f"data:image/png;base64, {data}"
 
 
-def get_qr_code_bytes(data: bytes | str, format: str = "PNG") -> bytes:
-    """Create a QR code and return the bytes."""
+def write_qr_code(data: bytes | str, stream: BytesIO, format: str = "PNG") -> None:
+    """Create a QR code and write it to the stream."""
     img = qrcode.make(data)
-
-    buffered = BytesIO()
-    img.save(buffered, format=format)
-
-    return buffered.getvalue()
-
-
-def bytes_to_base64_string(data: bytes) -> str:
-    """Convert bytes to a base64 encoded string."""
-    return b64encode(data).decode("utf-8")
+    img.save(stream, format=format)